@@ -1,9 +1,11 @@
 import logging as log
 import time
 import argparse
+from contextlib import closing
 
 
 from src.CryptoSources import Coindesk, Poloniex
+from src.utils import bulk_load
 import postgrez
 
 
@@ -37,5 +39,5 @@ elif args.source == 'Coindesk':
 results = crypto.main()
 
 if results:
-    postgrez.load('crypto', 'hist_prices', data=results['data'],
-                    columns=results['fields'])
+    with closing(postgrez.Connection(setup='crypto')) as db:
+        bulk_load(db.conn, 'hist_prices', results['fields'], results['data'])
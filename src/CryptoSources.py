@@ -29,11 +29,45 @@ results = {
 
 """
 
-from src.utils import DataCleaning, get_response, read_yaml, convert_to_epoch
+from src.utils import (check_date, get_response, read_yaml, convert_to_epoch,
+    default_dates, resolve_cleaners, clean_numeric_block, format_epoch)
 import datetime
+import json
 import logging as log
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
 
 CONFIG = read_yaml('src/config.yaml')
+## each source's fields with their cleaning functions looked up, kept separate
+## from CONFIG since read_yaml's cached result is shared
+FIELDS = {source: resolve_cleaners(source_config['fields'])
+            for source, source_config in CONFIG.items()}
+
+## one simdjson parser is shared by every source, so its internal buffers are
+## allocated once rather than per response. A parser can't be reused while
+## documents from its previous parse are still referenced, so each
+## _parse_response converts what it needs to python objects before returning.
+## The parser is not thread safe.
+_PARSER = simdjson.Parser() if simdjson is not None else None
+
+## cleaning functions handled by clean_numeric_data's compiled kernel
+NUMERIC_CLEANING_FUNCS = ('check_float', 'check_epoch')
+
+## coindesk wraps its json payload in a jsonp callback: cb({...});
+JSONP_PREFIX = b'cb('
+JSONP_SUFFIX = b');'
 
 
 def clean_data(data, fields):
@@ -55,34 +89,70 @@ def clean_data(data, fields):
                 }, ...
             }
             where the args component of each field is optional, and dependent on
-            the cleaning function.
+            the cleaning function. Fields must be the output of
+            resolve_cleaners.
     Returns:
-        cleaned_data (list): List of dicts, where each dict is
-            {'field1': cleaned_val1, ...}. Note, the field names here are still
-            the original field names from the API response.
+        cleaned_data (pandas.DataFrame): DataFrame with one row per record and
+            one column per field, where missing values or values that couldn't
+            be cleaned are None. Note, the column names here are still the
+            original field names from the API response.
     """
-    log.info('Attempting to clean %s records' % (len(data)))
-    cleaned_data = []
-    all_fields = fields.keys()
-
-    ## create a base dict with all the fields we expect in each record of data
-    base_dict = {key: None for key in all_fields}
-
-    for record in data:
-        ## create a copy of the base_dict, to be updated with the cleaned values
-        cleaned_record = base_dict.copy()
-
-        for var in all_fields:
-            val = record.get(var, None)
-            if val:
-                func = fields[var]['cleaning_func']
-                cleaned_record[var] = getattr(DataCleaning, func)(val=val,
-                                args=fields[var].get('args', None))
-            else:
-                cleaned_record[var] = None
+    log.info('Attempting to clean %s records', len(data))
 
-        cleaned_data.append(cleaned_record)
+    ## records missing a field get NaN for that column, and any field not in
+    ## fields is dropped
+    df = pd.DataFrame(data, columns=list(fields.keys()), dtype=object)
 
+    ## each cleaning function runs once over the whole column
+    for var, field in fields.items():
+        col = df[var]
+        present = col.notna() & col.astype(bool)
+        cleaned = field['_fn'](col, field['_args']).astype(object)
+        df[var] = cleaned.where(present & cleaned.notna(), None)
+
+    return df
+
+def clean_numeric_data(data, fields, columns):
+    """Fast path for clean_data, for records where every field is cleaned with
+    check_float or check_epoch (i.e. poloniex chart data). The records are
+    loaded into a single array and cleaned, in column order, by one compiled
+    kernel pass, skipping the DataFrame entirely.
+
+    Args:
+        data (list): List of dicts, where each dict is {'field1': val1, ...}
+        fields (dict): Fields config, as output by resolve_cleaners.
+        columns (list): Field names, in the order the cleaned columns should
+            be returned in.
+
+    Returns:
+        cleaned_data (numpy.ndarray): 2D object array with one row per record
+            and one column per entry in columns, where missing values or
+            values that couldn't be cleaned are None. None is returned instead
+            if a field isn't numeric, or a record is missing a field or has a
+            value that isn't a number, in which case clean_data should be used.
+    """
+    cleaning_funcs = [fields[var]['cleaning_func'] for var in columns]
+    if len(columns) < 2 or any(func not in NUMERIC_CLEANING_FUNCS
+                                for func in cleaning_funcs):
+        return None
+
+    get_values = itemgetter(*columns)
+    try:
+        raw = np.array([get_values(record) for record in data], dtype=object)
+        raw = raw.reshape(len(data), len(columns))
+        values = raw.astype('float64')
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    ## as in clean_data, falsy values (e.g. 0 but not '0') are missing
+    present = raw.astype(bool)
+    is_epoch = np.array([func == 'check_epoch' for func in cleaning_funcs])
+    cleaned = clean_numeric_block(values, present, is_epoch)
+
+    cleaned_data = cleaned.astype(object)
+    cleaned_data[np.isnan(cleaned)] = None
+    for j in np.flatnonzero(is_epoch):
+        cleaned_data[:, j] = format_epoch(cleaned[:, j])
     return cleaned_data
 
 class Coindesk():
@@ -100,12 +170,15 @@ class Coindesk():
         self.source = 'coindesk'
         self.config = CONFIG.get(self.source, None)
         if self.config is None:
-            log.error('%s has not been added to ./config.yaml. Exiting...'
-                % self.source)
+            log.error('%s has not been added to ./config.yaml. Exiting...',
+                self.source)
+
+        ## the db column order and the response field each column maps to are
+        ## fixed per source, so only work them out once
+        self._field_map = {d['mapped_name']:key
+                            for key, d in self.config['fields'].items()}
+        self._table_fields = [key for key in self._field_map.keys()]
 
-        self.base_url = ('https://api.coindesk.com/charts/data?output=json&'
-            'data=close&index={0}&startdate={1}&enddate={2}'
-            '&exchanges=bpi&dev=1')
         self.url = None
 
         self.tickers = ['USD', 'ETH']
@@ -124,28 +197,22 @@ class Coindesk():
         return
 
     def _validate_dates(self):
-        today_dt = datetime.datetime.today()
-        today = today_dt.strftime(self.date_format)
-        yest_dt = today_dt -datetime.timedelta(1)
-        yest = yest_dt.strftime(self.date_format)
-
-        start_dt_check = DataCleaning.check_date(date_text=self.start_date,
-                            date_format=self.date_format)
-        end_dt_check = DataCleaning.check_date(date_text=self.end_date,
-                            date_format=self.date_format)
-
-        if self.start_date is None or start_dt_check == False:
-            log.warning('Incorrect start date supplied, defaults to %s' % yest)
+        today_dt = datetime.date.today()
+        today, yest = default_dates(today_dt, self.date_format)
+
+        start_dt = check_date(self.start_date, self.date_format)
+        end_dt = check_date(self.end_date, self.date_format)
+
+        if start_dt is None:
+            log.warning('Incorrect start date supplied, defaults to %s', yest)
             self.start_date = yest
-        elif datetime.datetime.strptime(self.start_date, self.date_format) \
-                > today_dt:
+        elif start_dt.date() > today_dt:
             self.start_date = yest
 
-        if self.end_date is None or end_dt_check == False:
-            log.warning('Incorrect end date supplied, defaults to %s' % today)
+        if end_dt is None:
+            log.warning('Incorrect end date supplied, defaults to %s', today)
             self.end_date = today
-        elif datetime.datetime.strptime(self.end_date, self.date_format) \
-                > today_dt:
+        elif end_dt.date() > today_dt:
             self.end_date = today
 
         return
@@ -153,13 +220,14 @@ class Coindesk():
     def _validate_ticker(self):
         if self.ticker not in self.tickers:
             log.warning('Specified ticker %s not in Coindesk allowable tickers.'
-                'Defaulting to %s.' % (self.ticker, self.default_ticker))
+                'Defaulting to %s.', self.ticker, self.default_ticker)
             self.ticker = self.default_ticker
         return
 
     def _build_url(self):
-        self.url = self.base_url.format(self.ticker, self.start_date,
-                                            self.end_date)
+        self.url = ('https://api.coindesk.com/charts/data?output=json&'
+            f'data=close&index={self.ticker}&startdate={self.start_date}'
+            f'&enddate={self.end_date}&exchanges=bpi&dev=1')
         return
 
     def _parse_response(self, resp):
@@ -170,11 +238,23 @@ class Coindesk():
         data = None
         try:
             log.debug('Attempting to parse response')
-            raw_data = eval(resp.text.replace('cb(','').replace(');',''))
+            buf = resp.content
+            ## rfind only scans back from the end of the body
+            end = buf.rfind(JSONP_SUFFIX)
+            if not buf.startswith(JSONP_PREFIX) or end == -1:
+                raise ValueError('Response is not wrapped in %s...%s'
+                                    % (JSONP_PREFIX, JSONP_SUFFIX))
+            ## slice out the json without copying the body
+            payload = memoryview(buf)[len(JSONP_PREFIX):end]
+
+            if _PARSER is not None:
+                raw_data = _PARSER.parse(payload)
+            else:
+                raw_data = json.loads(bytes(payload))
             data = [{'timestamp': record[0], 'price': record[1]}
                         for record in raw_data['bpi']]
         except Exception as e:
-            log.error('Unable to parse response. Error %s' % (e))
+            log.error('Unable to parse response. Error %s', e)
         return data
 
 
@@ -189,24 +269,19 @@ class Coindesk():
             log.warning('No data was parsed from response. Exiting...')
             return
 
-        cleaned_data = clean_data(data, self.config['fields'])
-
-        field_map = {d['mapped_name']:key
-                        for key, d in self.config['fields'].items()}
+        cleaned_data = clean_data(data, FIELDS[self.source])
 
-        injection_data = []
-        table_fields = [key for key in field_map.keys()]
+        columns = [self._field_map[key] for key in self._table_fields]
 
         ##TODO: coindesk randomly returns shit outside of specified range,
         ## delete anything outside of start date/end date
-        for record in cleaned_data:
-            injection_record = []
-            for key in table_fields:
-                injection_record.append(record[field_map[key]])
-            injection_record += [self.ticker, self.source]
-            injection_data.append(injection_record)
-
-        table_fields += ['ticker', 'data_source']
+        injection_data = cleaned_data[columns].to_numpy(dtype=object)
+        injection_data = np.hstack([injection_data,
+            np.full((len(injection_data), 1), self.ticker, dtype=object),
+            np.full((len(injection_data), 1), self.source, dtype=object)])
+        injection_data = injection_data.tolist()
+
+        table_fields = self._table_fields + ['ticker', 'data_source']
         return {'fields': table_fields, 'data': injection_data}
 
 
@@ -231,13 +306,15 @@ class Poloniex():
         self.source = 'poloniex'
         self.config = CONFIG.get(self.source, None)
         if self.config is None:
-            log.error('%s has not been added to ./config.yaml. Exiting...'
-                % self.source)
+            log.error('%s has not been added to ./config.yaml. Exiting...',
+                self.source)
+
+        ## the db column order and the response field each column maps to are
+        ## fixed per source, so only work them out once
+        self._field_map = {d['mapped_name']:key
+                            for key, d in self.config['fields'].items()}
+        self._table_fields = [key for key in self._field_map.keys()]
 
-        self.base_url = ('https://poloniex.com/public?command=returnChartData'
-            '&currencyPair=BTC_ETH&start=1498881600&end=9999999999&period=300')
-        self.base_url = ('https://poloniex.com/public?command=returnChartData'
-            '&currencyPair={0}&start={1}&end={2}&period={3}')
         self.url = None
 
         self.ticker = ticker_pair
@@ -256,29 +333,22 @@ class Poloniex():
         return
 
     def _validate_dates(self):
-        today_dt = datetime.datetime.today()
-        today = today_dt.strftime(self.date_format)
-        yest_dt = today_dt -datetime.timedelta(1)
-        yest = yest_dt.strftime(self.date_format)
-
-        start_dt_check = DataCleaning.check_date(date_text=self.start_date,
-                            date_format=self.date_format)
-        end_dt_check = DataCleaning.check_date(date_text=self.end_date,
-                            date_format=self.date_format)
-
-        if self.start_date is None or start_dt_check == False:
-            log.warning('Incorrect start date supplied, defaults to %s' % yest)
-            self.start_date = yest
+        today_dt = datetime.date.today()
+        today, yest = default_dates(today_dt, self.date_format)
+
+        start_dt = check_date(self.start_date, self.date_format)
+        end_dt = check_date(self.end_date, self.date_format)
 
-        elif datetime.datetime.strptime(self.start_date, self.date_format) \
-                > today_dt:
+        if start_dt is None:
+            log.warning('Incorrect start date supplied, defaults to %s', yest)
+            self.start_date = yest
+        elif start_dt.date() > today_dt:
             self.start_date = yest
 
-        if self.end_date is None or end_dt_check == False:
-            log.warning('Incorrect end date supplied, defaults to %s' % today)
+        if end_dt is None:
+            log.warning('Incorrect end date supplied, defaults to %s', today)
             self.end_date = today
-        elif datetime.datetime.strptime(self.end_date, self.date_format) \
-                > today_dt:
+        elif end_dt.date() > today_dt:
             self.end_date = today
 
         return
@@ -308,8 +378,9 @@ class Poloniex():
         return
 
     def _build_url(self):
-        self.url = self.base_url.format(self.ticker, self.start_date,
-                                            self.end_date, self.period)
+        self.url = ('https://poloniex.com/public?command=returnChartData'
+            f'&currencyPair={self.ticker}&start={self.start_date}'
+            f'&end={self.end_date}&period={self.period}')
         return
 
     def _parse_response(self, resp):
@@ -320,9 +391,17 @@ class Poloniex():
         data = None
         try:
             log.debug('Attempting to parse response')
-            data = resp.json()
+            if _PARSER is not None:
+                doc = _PARSER.parse(resp.content)
+                ## chart data comes back as an array, errors as an object
+                data = (doc.as_list() if isinstance(doc, simdjson.Array)
+                            else doc.as_dict())
+            elif orjson is not None:
+                data = orjson.loads(resp.content)
+            else:
+                data = resp.json()
         except Exception as e:
-            log.error('Unable to parse response. Error %s' % (e))
+            log.error('Unable to parse response. Error %s', e)
         return data
 
 
@@ -339,22 +418,19 @@ class Poloniex():
 
         if isinstance(data, dict) and 'error' in data.keys():
             log.error('No data returned from response. Error message %s. '
-                        'Exiting...' % data['error'])
+                        'Exiting...', data['error'])
             return
 
-        cleaned_data = clean_data(data, self.config['fields'])
-
-        field_map = {d['mapped_name']:key
-                        for key, d in self.config['fields'].items()}
+        columns = [self._field_map[key] for key in self._table_fields]
+        injection_data = clean_numeric_data(data, FIELDS[self.source], columns)
+        if injection_data is None:
+            cleaned_data = clean_data(data, FIELDS[self.source])
+            injection_data = cleaned_data[columns].to_numpy(dtype=object)
 
-        injection_data = []
-        table_fields = [key for key in field_map.keys()]
-        for record in cleaned_data:
-            injection_record = []
-            for key in table_fields:
-                injection_record.append(record[field_map[key]])
-            injection_record += [self.ticker, self.source]
-            injection_data.append(injection_record)
+        injection_data = np.hstack([injection_data,
+            np.full((len(injection_data), 1), self.ticker, dtype=object),
+            np.full((len(injection_data), 1), self.source, dtype=object)])
+        injection_data = injection_data.tolist()
 
-        table_fields += ['ticker', 'data_source']
+        table_fields = self._table_fields + ['ticker', 'data_source']
         return {'fields': table_fields, 'data': injection_data}
@@ -1,11 +1,47 @@
-import requests
+import httpx
 import yaml
 import logging as log
-import time
 import datetime
+import calendar
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit when numba isn't installed, runs the
+        decorated function as plain python.
+        """
+        def decorator(func):
+            return func
+        return decorator
+
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+## shared client so repeated requests to the same host reuse connections. httpx
+## negotiates compression by default (brotli too, when installed), and HTTP/2
+## is used when the h2 package (httpx[http2]) is installed
+MAX_CONNECTIONS = 16
+CLIENT = httpx.Client(http2=h2 is not None, follow_redirects=True,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                max_keepalive_connections=MAX_CONNECTIONS))
+
+@lru_cache(maxsize=None)
 def read_yaml(yaml_file):
-    """Read a yaml file.
+    """Read a yaml file. Results are cached, so repeat reads of the same file
+    return the same (shared) dictionary without re-parsing.
 
     Args:
         yaml_file (str): Full path of the yaml file.
@@ -20,13 +56,29 @@ def read_yaml(yaml_file):
     data = None
     try:
         with open(yaml_file) as f:
-            # use safe_load instead load
-            data = yaml.safe_load(f)
+            # use the safe loader, with the libyaml C bindings when available
+            data = yaml.load(f, Loader=YAML_LOADER)
     except Exception as e:
-        log.error('Unable to read file %s. Error: %s' % (yaml_file, e))
+        log.error('Unable to read file %s. Error: %s', yaml_file, e)
         raise
     return data
 
+@lru_cache(maxsize=4)
+def default_dates(today, date_format='%Y-%m-%d'):
+    """Format the default start and end dates for a given day. Cached, since
+    every source object constructed on the same day gets the same defaults.
+
+    Args:
+        today (datetime.date): Today's date
+        date_format (str): Date format to return the dates in. Defaults to
+            '%Y-%m-%d'
+
+    Returns:
+        dates (tuple): (today, yesterday) as date strings
+    """
+    yesterday = today - datetime.timedelta(1)
+    return today.strftime(date_format), yesterday.strftime(date_format)
+
 def convert_to_epoch(date, date_format='%Y-%m-%d'):
     """Convert a string date to Epoch GMT time.
 
@@ -39,130 +91,278 @@ def convert_to_epoch(date, date_format='%Y-%m-%d'):
         epoch_time (int): Epoch GMT time
 
     """
+    date_dt = None
+    if date_format == '%Y-%m-%d':
+        ## skip the format string parsing for the format every source uses.
+        ## fromisoformat needs zero padded dates though, which strptime
+        ## doesn't, so anything like 2017-7-1 still goes through strptime
+        try:
+            date_dt = datetime.date.fromisoformat(date)
+        except ValueError:
+            pass
+    if date_dt is None:
+        date_dt = datetime.datetime.strptime(date, date_format)
 
-    return int(time.mktime(time.strptime(date, date_format)))
+    return calendar.timegm(date_dt.timetuple())
 
-def get_response(url):
+def get_response(url, timeout=30):
     """Retrieve the response from a url.
 
     Args:
         url (str): Url to retrieve response from.
+        timeout (int): Seconds to wait for the server before giving up.
+            Defaults to 30.
 
     Returns:
-        resp (requests.models.Response): Requests response object. If the
-            resp.status_code != 200, returns None
+        resp (httpx.Response): Response object. If the resp.status_code != 200,
+            returns None
     """
-    log.info('Retrieving response from %s' % url)
+    log.info('Retrieving response from %s', url)
     resp = None
     try:
-        resp = requests.get(url)#, data=json.dumps(r_payload), headers=self.headers)
+        resp = CLIENT.get(url, timeout=timeout)
         if resp.status_code != 200:
+            log.error('Unable to get response, status code %s',
+                        resp.status_code)
             resp = None
-            log.error('Unable to get response, status code %s'
-                        % resp.status_code)
     except Exception as e:
-        log.error("Error getting response %s" % e)
+        log.error("Error getting response %s", e)
 
     return resp
 
+def get_responses(urls, timeout=30):
+    """Retrieve the responses from a list of urls concurrently.
+
+    Args:
+        urls (list): Urls to retrieve responses from.
+        timeout (int): Seconds to wait for the server before giving up on each
+            url. Defaults to 30.
+
+    Returns:
+        resps (list): httpx.Response objects, in the same order as urls.
+            Any url that failed or didn't return a 200 has a None in its place.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+        return list(executor.map(lambda url: get_response(url, timeout),
+                                    urls))
+
+## marker written for None values, loaded as NULL by bulk_load's COPY
+COPY_NULL = '\\N'
+
+def bulk_load(conn, table, fields, data):
+    """Load rows into a table with a single COPY FROM STDIN, rather than an
+    insert per row.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection.
+        table (str): Name of the table to load into.
+        fields (list): Column names, in the same order as each row of data.
+        data (list): List of rows, where each row is a list of values. None
+            values are loaded as NULL.
+    """
+    log.info('Loading %s rows into %s', len(data), table)
+    ## csv.writer writes None and '' the same way, so None gets an explicit
+    ## NULL marker to keep empty strings from loading as NULL
+    buf = io.StringIO()
+    csv.writer(buf).writerows([[COPY_NULL if val is None else val
+                                    for val in row] for row in data])
+    buf.seek(0)
+
+    query = sql.SQL('COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL {})')
+    query = query.format(
+                sql.Identifier(table),
+                sql.SQL(', ').join(sql.Identifier(field) for field in fields),
+                sql.Literal(COPY_NULL))
+    with conn.cursor() as cursor:
+        cursor.copy_expert(query.as_string(conn), buf)
+    conn.commit()
+    return
+
+
+@njit(cache=True)
+def check_epoch_batch(timestamps):
+    """Convert an array of 10 digit (seconds) or 13 digit (milliseconds) epoch
+    timestamps to seconds since epoch. Each value is classified with integer
+    compares rather than by counting digits, so the loop compiles down to
+    compare and select instructions.
+
+    Args:
+        timestamps (numpy.ndarray): int64 array of epoch timestamps
+
+    Returns:
+        seconds (numpy.ndarray): int64 array of seconds since epoch, with -1
+            for any value that isn't a 10 or 13 digit timestamp. Only positive
+            timestamps are accepted, so e.g. -123456789 (10 characters long)
+            is rejected.
+    """
+    seconds = np.empty_like(timestamps)
+    for i in range(timestamps.shape[0]):
+        ts = timestamps[i]
+        is_millis = (ts >= 1000000000000) & (ts < 10000000000000)
+        is_secs = (ts >= 1000000000) & (ts < 10000000000)
+        ts = ts // 1000 if is_millis else ts
+        seconds[i] = ts if (is_millis | is_secs) else -1
+    return seconds
+
+@njit(cache=True)
+def clean_numeric_block(values, present, is_epoch):
+    """Clean a 2D block of numeric values, one column per field, in a single
+    pass. Float columns are kept as is, and epoch columns are converted
+    from 10 digit (seconds) or 13 digit (milliseconds) timestamps to seconds
+    since epoch.
+
+    Args:
+        values (numpy.ndarray): 2D float64 array of raw values
+        present (numpy.ndarray): 2D bool array, False where the raw value was
+            missing or falsy
+        is_epoch (numpy.ndarray): bool array, True for each epoch column
+
+    Returns:
+        cleaned (numpy.ndarray): 2D float64 array of cleaned values, with NaN
+            for anything missing or that isn't a valid timestamp
+    """
+    cleaned = np.empty_like(values)
+    for i in range(values.shape[0]):
+        for j in range(values.shape[1]):
+            val = values[i, j]
+            if not present[i, j]:
+                cleaned[i, j] = np.nan
+            elif is_epoch[j]:
+                ts = np.trunc(val)
+                if ts >= 1e12 and ts < 1e13:
+                    cleaned[i, j] = ts // 1000
+                elif ts >= 1e9 and ts < 1e10:
+                    cleaned[i, j] = ts
+                else:
+                    cleaned[i, j] = np.nan
+            else:
+                cleaned[i, j] = val
+    return cleaned
+
+def format_epoch(seconds):
+    """Format seconds since epoch as '%Y-%m-%d %H:%M' strings.
+
+    Args:
+        seconds (numpy.ndarray): float64 array of seconds since epoch, with NaN
+            for missing values
+
+    Returns:
+        parsed (numpy.ndarray): object array of time strings, with None where
+            seconds is NaN
+    """
+    parsed = np.full(seconds.shape, None, dtype=object)
+    valid = ~np.isnan(seconds)
+    ## numpy can't format an empty datetime64 array
+    if valid.any():
+        ## numpy formats datetime64 as '%Y-%m-%dT%H:%M' far faster than
+        ## strftime
+        valid_dt = seconds[valid].astype('int64').astype('datetime64[s]')
+        parsed[valid] = np.char.replace(
+            np.datetime_as_string(valid_dt, unit='m'), 'T', ' ').astype(object)
+    return parsed
+
+def check_int(col, args=None):
+    """Function to check if the field is an integer and convert if necessary"""
+    numeric = pd.to_numeric(col, errors='coerce')
+    ## NaNs and anything that can't fit in an int64 can't be converted
+    valid = numeric.abs() < 2**63
 
-class DataCleaning():
-    # TODO: rethink this class
-    def __init__(self):
+    ## as with int(), strings have to be whole numbers, i.e. '3.5' isn't an
+    ## int. Non-strings give NaN from the .str accessor, and pass
+    try:
+        whole = col.str.fullmatch(r'\s*[+-]?\d+\s*').fillna(True)
+        valid &= whole.astype(bool)
+    except AttributeError:
+        ## pandas refuses the .str accessor when col has no strings at all
         pass
 
-    @classmethod
-    def check_int(cls, **kwargs):
-        """Function to check if the field is an integer and convert if necessary"""
-        int_check = isinstance(kwargs['val'], int )
-        val = kwargs['val']
-        if int_check == False:
-            try:
-                val = int(kwargs['val'])
-            except Exception as e:
-                log.debug('Unable to convert %s to an integer due to error %s'
-                    % (val, e))
-                val = None
-        return val
-
-
-    @classmethod
-    def check_float(cls, **kwargs):
-        """Function to check if the field is a float and convert if necessary"""
-        float_check = isinstance(kwargs['val'], float )
-        val = kwargs['val']
-        if float_check == False:
-            try:
-                val = float(kwargs['val'])
-            except Exception as e:
-                log.debug('Unable to convert %s to an integer due to error %s'
-                    % (val, e))
-                val = None
-        return val
-
-    @classmethod
-    def check_varchar(cls, **kwargs):
-        """Function to censure the field is the correct length and
-            trunctuate if necessary.
-        """
-        val = kwargs['val']
-        try:
-            cleaned_val = str(val)[0:kwargs['args']['length']]
-            cleaned_val = cleaned_val.replace('\\','')
-        except Exception as e:
-            log.debug('Unable to convert %s to a string due to error %s' %
-                    (val, e))
-            cleaned_val = None
-        return cleaned_val
-
-    @classmethod
-    def check_text(cls, **kwargs):
-        """Function to ensure the field is a string"""
-        val = kwargs['val']
-        try:
-            cleaned_val = str(val)
-            cleaned_val = cleaned_val.replace('\\','')
-        except Exception as e:
-            log.debug('Unable to convert %s to a string due to error %s' %
-                    (val, e))
-            cleaned_val = None
-        return cleaned_val
-
-    @classmethod
-    def do_none(cls, **kwargs):
-        return kwargs['val']
-
-    @classmethod
-    def check_epoch(cls, **kwargs):
-        """Checks if the supplied value is an 10 or 13 digit integer. If it is,
-        returns a parsed time in the format '%Y-%m-%d %H:%M'. Otherwise, returns
-        None.
-        """
-        timestamp = kwargs['val']
-        if isinstance(timestamp, int) == False:
-            try:
-                timestamp = int(timestamp)
-            except:
-                return None
-
-        if len(str(timestamp)) == 13:
-            timestamp = int(timestamp/1000)
-        elif len(str(timestamp)) != 10:
-            return None
-
-        return time.strftime('%Y-%m-%d %H:%M', time.gmtime(timestamp))
-
-    @classmethod
-    def check_date(cls, **kwargs):
-        date_text = kwargs['date_text']
-        date_format = (kwargs['date_format'] if kwargs['date_format']
-                        else '%Y-%m-%d')
-        if isinstance(date_text, str) == False:
-            return False
+    return np.trunc(numeric.where(valid)).astype('Int64')
 
-        try:
-            datetime.datetime.strptime(date_text, date_format)
-            return True
-        except ValueError:
-            # raise ValueError("Incorrect data format, should be YYYY-MM-DD")
-            return False
+def check_float(col, args=None):
+    """Function to check if the field is a float and convert if necessary"""
+    return pd.to_numeric(col, errors='coerce').astype('float64')
+
+def check_varchar(col, args):
+    """Function to censure the field is the correct length and
+        trunctuate if necessary.
+    """
+    col = col.astype(str).str.slice(0, args['length'])
+    return col.str.replace('\\', '', regex=False)
+
+def check_text(col, args=None):
+    """Function to ensure the field is a string"""
+    return col.astype(str).str.replace('\\', '', regex=False)
+
+def do_none(col, args=None):
+    return col
+
+def check_epoch(col, args=None):
+    """Checks if the supplied values are positive 10 or 13 digit integers. If
+    they are, returns parsed times in the format '%Y-%m-%d %H:%M'. Otherwise,
+    returns NaN.
+    """
+    timestamp = np.trunc(pd.to_numeric(col, errors='coerce'))
+    ## NaNs and anything too big to fit in an int64 become 0, which
+    ## check_epoch_batch flags as invalid along with everything else that
+    ## isn't 10 or 13 digits
+    timestamp = timestamp.where(timestamp.abs() < 1e13, 0)
+
+    seconds = check_epoch_batch(timestamp.to_numpy(dtype='int64'))
+    seconds = np.where(seconds >= 0, seconds, np.nan)
+
+    return pd.Series(format_epoch(seconds), index=timestamp.index)
+
+## cleaning functions that can be referenced by the cleaning_func key of each
+## field in ./config.yaml. Each one takes a pandas Series of raw values and the
+## field's args, and returns a Series of cleaned values where anything that
+## couldn't be cleaned is left as NaN.
+CLEANERS = {
+    'check_int': check_int,
+    'check_float': check_float,
+    'check_varchar': check_varchar,
+    'check_text': check_text,
+    'do_none': do_none,
+    'check_epoch': check_epoch,
+}
+
+def resolve_cleaners(fields):
+    """Look up the cleaning function of each field once. The fields config
+    passed in is left untouched.
+
+    Args:
+        fields (dict): Fields config, in the format described by clean_data.
+
+    Returns:
+        resolved_fields (dict): Copy of fields, where each field also has its
+            cleaning function under _fn and its arguments under _args.
+
+    Raises:
+        Exception: If a field references a cleaning function not in CLEANERS
+    """
+    resolved_fields = {}
+    for var, field in fields.items():
+        if field['cleaning_func'] not in CLEANERS:
+            raise Exception('Unknown cleaning function %s for field %s. '
+                            'Must be one of %s' % (field['cleaning_func'], var,
+                            list(CLEANERS.keys())))
+        resolved_fields[var] = dict(field,
+                                    _fn=CLEANERS[field['cleaning_func']],
+                                    _args=field.get('args', None))
+    return resolved_fields
+
+def check_date(date_text, date_format='%Y-%m-%d'):
+    """Parses a date string.
+
+    Returns:
+        date_dt (datetime.datetime): The parsed date, or None if date_text
+            isn't a string in date_format.
+    """
+    date_format = date_format if date_format else '%Y-%m-%d'
+    if isinstance(date_text, str) == False:
+        return None
+
+    try:
+        return datetime.datetime.strptime(date_text, date_format)
+    except ValueError:
+        # raise ValueError("Incorrect data format, should be YYYY-MM-DD")
+        return None
@@ -0,0 +1,132 @@
+"""Regression tests pinning the rows each source's main() returns for a fixed
+response payload. Run from the repo root, since src/CryptoSources.py reads
+src/config.yaml relative to it.
+"""
+import json
+
+import src.CryptoSources as CryptoSources
+from src.CryptoSources import (Coindesk, Poloniex, FIELDS, clean_data,
+    clean_numeric_data)
+from src.utils import convert_to_epoch, read_yaml, resolve_cleaners
+
+
+class FakeResponse():
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def test_poloniex_main(monkeypatch):
+    payload = [
+        {'date': 1500000000, 'high': 0.08, 'low': '0.07', 'open': 0.075,
+            'close': 0, 'volume': '0', 'quoteVolume': 'abc',
+            'weightedAverage': 0.0755},
+        {'date': 1500000300000, 'high': '0.0'},
+        {'date': 123, 'close': 0.081},
+    ]
+    resp = FakeResponse(json.dumps(payload).encode())
+    monkeypatch.setattr(CryptoSources, 'get_response', lambda url: resp)
+
+    results = Poloniex('BTC_ETH', '2017-07-01', '2017-07-02').main()
+
+    assert results['fields'] == ['snap_time', 'high', 'low', 'open', 'close',
+        'base_volume', 'quote_volume', 'weighted_avg', 'ticker', 'data_source']
+    assert results['data'] == [
+        ['2017-07-14 02:40', 0.08, 0.07, 0.075, None, 0.0, None, 0.0755,
+            'BTC_ETH', 'poloniex'],
+        ['2017-07-14 02:45', 0.0, None, None, None, None, None, None,
+            'BTC_ETH', 'poloniex'],
+        [None, None, None, None, 0.081, None, None, None,
+            'BTC_ETH', 'poloniex'],
+    ]
+
+
+def test_coindesk_main(monkeypatch):
+    resp = FakeResponse(b'cb({"bpi":[[1500000000000,2000.5],'
+                        b'[1500000060000,null]]});\n')
+    monkeypatch.setattr(CryptoSources, 'get_response', lambda url: resp)
+
+    results = Coindesk('USD', '2017-07-01', '2017-07-02').main()
+
+    assert results['fields'] == ['snap_time', 'close', 'ticker',
+                                    'data_source']
+    assert results['data'] == [
+        ['2017-07-14 02:40', 2000.5, 'USD', 'coindesk'],
+        ['2017-07-14 02:41', None, 'USD', 'coindesk'],
+    ]
+
+
+def test_clean_data_check_int():
+    fields = resolve_cleaners({'val': {'cleaning_func': 'check_int'}})
+    data = [{'val': val} for val in
+                ['3', '3.5', 3.7, 1e19, 2**70, None, 0, '-4']]
+    data.append({})
+
+    cleaned = clean_data(data, fields)
+
+    assert cleaned['val'].tolist() == [3, None, 3, None, None, None, None, -4,
+                                        None]
+
+
+def test_resolve_cleaners_leaves_config_untouched():
+    fields = read_yaml('src/config.yaml')['poloniex']['fields']
+    resolved = resolve_cleaners(fields)
+
+    assert all('_fn' in field for field in resolved.values())
+    assert not any('_fn' in field for field in fields.values())
+
+
+def test_convert_to_epoch():
+    assert convert_to_epoch('2017-07-01') == 1498867200
+    assert convert_to_epoch('2017-7-1') == 1498867200
+    assert convert_to_epoch('2017-07-01 12:00', '%Y-%m-%d %H:%M') == 1498910400
+
+
+def test_poloniex_unpadded_dates():
+    crypto = Poloniex('BTC_ETH', '2017-7-1', '2017-7-2')
+
+    assert crypto.start_date == 1498867200
+    assert crypto.end_date == 1498953600
+
+
+def test_empty_responses(monkeypatch):
+    resp = FakeResponse(b'[]')
+    monkeypatch.setattr(CryptoSources, 'get_response', lambda url: resp)
+    results = Poloniex('BTC_ETH', '2017-07-01', '2017-07-02').main()
+    assert results['data'] == []
+
+    resp = FakeResponse(b'cb({"bpi":[]});')
+    monkeypatch.setattr(CryptoSources, 'get_response', lambda url: resp)
+    results = Coindesk('USD', '2017-07-01', '2017-07-02').main()
+    assert results == {'fields': ['snap_time', 'close', 'ticker',
+                                    'data_source'], 'data': []}
+
+
+def test_clean_numeric_data_matches_clean_data():
+    fields = FIELDS['poloniex']
+    columns = list(fields.keys())
+    data = [
+        {'date': 1500000000, 'high': 0.08, 'low': '0.07', 'open': 0,
+            'close': '0', 'volume': 12, 'quoteVolume': 0.0,
+            'weightedAverage': 0.0755},
+        {'date': 1500000300000, 'high': '0.0', 'low': 1, 'open': 2,
+            'close': 3, 'volume': 4, 'quoteVolume': 5, 'weightedAverage': 6},
+        {'date': 123, 'high': 1, 'low': 1, 'open': 1, 'close': 1,
+            'volume': 1, 'quoteVolume': 1, 'weightedAverage': 1},
+    ]
+
+    cleaned = clean_numeric_data(data, fields, columns)
+
+    assert cleaned is not None
+    assert cleaned.tolist() == \
+        clean_data(data, fields)[columns].to_numpy(dtype=object).tolist()
+    assert cleaned[0].tolist() == ['2017-07-14 02:40', 0.08, 0.07, None, 0.0,
+                                    12.0, None, 0.0755]
+
+    ## anything non-numeric or missing is left to clean_data
+    assert clean_numeric_data([{'date': 1500000000}], fields, columns) is None
+    data[0]['high'] = 'abc'
+    assert clean_numeric_data(data, fields, columns) is None